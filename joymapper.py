@@ -17,8 +17,9 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import functools
-import select
+import errno
+import os
+import selectors
 import struct
 import sys
 import argparse
@@ -26,13 +27,12 @@ import time
 import logging
 from collections import namedtuple
 
-import Xlib.X
-import Xlib.XK
 import Xlib.display
 # This isn't used, but it needs to be loaded to prime the extension.
 import Xlib.ext.xtest
-import Xlib.keysymdef.latin1
-import Xlib.keysymdef.miscellany
+
+from keysender import CHORD_DELAY, X_IDLE_TIMEOUT, UInputSender, \
+    XTestSender
 
 Input = namedtuple("Input", ('control', 'keyspec', 'desc'))
 
@@ -52,7 +52,7 @@ Input = namedtuple("Input", ('control', 'keyspec', 'desc'))
 #
 # Multi-key list elements:
 #
-# tuple => emit chord
+# tuple => emit chord (a trailing int overrides CHORD_DELAY for that chord)
 # str => emit key
 # int => wait X miliseconds
 #
@@ -101,59 +101,116 @@ MAPPING = {
 # What device are we looking at?
 CONTROLLER_DEVICE = '/dev/input/js0'
 
+# struct js_event from linux/joystick.h
+INPUT_STRUCT = struct.Struct('IhBB')
+# How many events to pull from the driver per read()
+JS_READ_SIZE = INPUT_STRUCT.size * 64
+# js_event.type flag for the synthetic events describing the initial state
+JS_EVENT_INIT = 0x80
+
+
+def js_index(typ, number, value):
+    # Pack an event into an index into Program.dispatch.  Only the sign of
+    # the value fits, so the entry keeps the exact value to check against.
+    # (type is 1 or 2 once JS_EVENT_INIT is ruled out, number is a byte.)
+    return (typ << 10) | (number << 2) | ((value > 0) << 1) | (value < 0)
+
 
 class Program:
 
-    @functools.lru_cache()
-    def keysym2code(self, key):
-        rv = self.display.keysym_to_keycode(Xlib.XK.string_to_keysym(key))
-        if not rv:              # I think it returns 0, but maybe None
-            raise Exception("No keycode for keysym '{}'".format(key))
-        return rv
-
-    def send_chord(self, keys):
-        logging.debug("chord=%s", keys)
-        keycodes = list(map(self.keysym2code, keys))
-        # We set the times with 10ms between the modifiers, the final
-        # key, and the release.  (The default for the last argument is
-        # X.CurrentTime.)
-        for k in keycodes[:-1]:
-            self.display.xtest_fake_input(Xlib.X.KeyPress, k, 0)
-        self.display.xtest_fake_input(Xlib.X.KeyPress, keycodes[-1], 10)
-        for k in reversed(keycodes):
-            self.display.xtest_fake_input(Xlib.X.KeyRelease, k, 20)
-        # Send the event stream.
-        self.display.flush()
-
-    def send_key(self, key):
-        logging.debug("key=%s", key)
-        keycode = self.keysym2code(key)
-        self.display.xtest_fake_input(Xlib.X.KeyPress, keycode)
-        self.display.xtest_fake_input(Xlib.X.KeyRelease, keycode)
-        self.display.flush()
+    def __init__(self, use_uinput=False, debug=False):
+        self.use_uinput = use_uinput
+        self.debug = debug
+
+    def compile_keyspec(self, keyspec, inp):
+        # Turn a keyspec into a list of (function, arg) pairs with the
+        # keysyms already compiled by the sender, so that handling an event
+        # doesn't have to pick the keyspec apart again.
+        if not keyspec:
+            return []
+        if not isinstance(keyspec, list):
+            keyspec = [keyspec]
+        program = []
+        for elem in keyspec:
+            compile_fn = self.compilers.get(type(elem))
+            if compile_fn is None:
+                raise Exception(
+                    "Unsupported keyspec of type {} in Input {}".
+                    format(type(elem), inp))
+            program.append(compile_fn(elem))
+        return program
+
+    def compile_key(self, key):
+        return self.sender.send_key, self.sender.compile_key(key)
+
+    def compile_chord(self, keys):
+        delay = CHORD_DELAY
+        if isinstance(keys[-1], int):
+            keys, delay = keys[:-1], keys[-1]
+        return self.sender.send_chord, self.sender.compile_chord(keys, delay)
+
+    def compile_sleep(self, millis):
+        # Sleep times are specified in milliseconds
+        return self.pause, millis / 1000
+
+    def compile_mapping(self):
+        self.compilers = {
+            str: self.compile_key,
+            tuple: self.compile_chord,
+            int: self.compile_sleep,
+        }
+        self.dispatch = [None] * (1 << 12)
+        for (typ, number, value), inp in MAPPING.items():
+            self.dispatch[js_index(typ, number, value)] = (
+                value, inp, self.compile_keyspec(inp.keyspec, inp))
+        self.sender.start()
+
+    def pause(self, seconds):
+        # Get any queued keystrokes out before going to sleep
+        self.sender.flush()
+        time.sleep(seconds)
 
     def handle_x(self):
         # We don't need to process any X events, but we do need to
-        # read the X responses to prevent them from piling up.
+        # read the X responses to prevent them from piling up.  XTEST
+        # requests don't generate replies, so all that ever turns up is the
+        # odd error or MappingNotify; that can wait for the next catch-up
+        # (every X_IDLE_TIMEOUT seconds) rather than being decoded on every
+        # wakeup.
         for _ in range(self.display.pending_events()):
             self.display.next_event()
 
     def handle_js(self):
-        evbuf = None
-        try:
-            evbuf = self.jsdev.read(8)
-        except OSError as ose:
-            if ose.errno == 19:
-                # 19 == No such device == disconnected
-                pass
-            else:
-                raise
-        if not evbuf:
-            # In practice we only get here in the OSError case
-            logging.info("Controller disconnected or unavailable at '%s'.",
-                         CONTROLLER_DEVICE)
-            sys.exit(0)
+        # The device is non-blocking, so keep reading until the driver has
+        # nothing left, rather than going back to the selector per event.
+        # The driver only ever hands back whole events, so each read can be
+        # unpacked in one go.
+        while True:
+            evbuf = None
+            try:
+                evbuf = os.read(self.jsfd, JS_READ_SIZE)
+            except BlockingIOError:
+                return
+            except OSError as ose:
+                if ose.errno == errno.ENODEV:
+                    # No such device == disconnected
+                    pass
+                else:
+                    raise
+            if not evbuf:
+                # In practice we only get here in the OSError case
+                logging.info("Controller disconnected or unavailable at '%s'.",
+                             CONTROLLER_DEVICE)
+                sys.exit(0)
+            for event in INPUT_STRUCT.iter_unpack(evbuf):
+                self.handle_js_event(*event)
+            # One write for the keystrokes from the whole batch
+            self.sender.flush()
+            if len(evbuf) < JS_READ_SIZE:
+                # Short read, so the queue is empty; skip the EAGAIN read.
+                return
 
+    def handle_js_event(self, _time, value, typ, number):
         # *** THIS IS WHERE WE DISPATCH JOYSTICK STUFF TO X STUFF ***
         # To read the joystick, see:
         #     https://www.kernel.org/doc/Documentation/input/joystick-api.txt
@@ -163,56 +220,59 @@ class Program:
         # To see the names of X keysyms, see:
         #     X11/keysymdef.h
         # The Python keysymdef modules are based on the preceding #ifdef.
-        _time, value, typ, number = struct.unpack('IhBB', evbuf)
-        inp = MAPPING.get((typ, number, value))
-        if inp:
+        if typ & JS_EVENT_INIT:
+            return
+        # js_index(), inlined
+        entry = self.dispatch[
+            (typ << 10) | (number << 2) | ((value > 0) << 1) | (value < 0)]
+        if entry and entry[0] == value:
+            _value, inp, program = entry
             logging.info("Controller event %s => %s", inp.control, inp.desc)
-            if not inp.keyspec:
-                pass
-            if isinstance(inp.keyspec, list):
-                for elem in inp.keyspec:
-                    if isinstance(elem, str):
-                        self.send_key(elem)
-                    elif isinstance(elem, int):
-                        time.sleep(elem)
-                    elif isinstance(elem, tuple):
-                        self.send_chord(elem)
-                    else:
-                        raise Exception(
-                            "Unsupported keyspec of type {} in Input {}".
-                            format(type(elem), inp))
-            elif isinstance(inp.keyspec, str):
-                self.send_key(inp.keyspec)
-        elif abs(value) in (1, 32767):
+            for fn, arg in program:
+                fn(arg)
+        elif self.debug and abs(value) in (1, 32767):
             logging.debug("Controller event: type %d number %d value %d",
                           typ, number, value)
 
     def run(self):
+        # Even with --uinput we need the display to look up keycodes.
         self.display = Xlib.display.Display()
-        ext = self.display.query_extension('XTEST')
-        if ext is None:
-            raise Exception("Cannot get XTEST extension")
+        if self.use_uinput:
+            sender_class = UInputSender
+        else:
+            sender_class = XTestSender
+        self.sender = sender_class(self.display, 'joymapper',
+                                   debug=self.debug)
+        self.compile_mapping()
 
-        self.jsdev = open(CONTROLLER_DEVICE, 'rb')
+        self.jsfd = os.open(CONTROLLER_DEVICE, os.O_RDONLY | os.O_NONBLOCK)
         logging.info("Mapping inputs from %s", CONTROLLER_DEVICE)
 
-        while True:
-            (ready_to_read, _, _) = select.select(
-                [self.display, self.jsdev], [], [])
+        # epoll on Linux.  The handler for each fd rides along as its data.
+        sel = selectors.DefaultSelector()
+        sel.register(self.jsfd, selectors.EVENT_READ, self.handle_js)
 
-            if self.display in ready_to_read:
+        # A jittery axis can keep the selector busy indefinitely, so X
+        # traffic is caught up on a timer rather than only when idle.
+        x_due = time.monotonic() + X_IDLE_TIMEOUT
+        while True:
+            for key, _ in sel.select(max(x_due - time.monotonic(), 0)):
+                key.data()
+            now = time.monotonic()
+            if now >= x_due:
                 self.handle_x()
-
-            if self.jsdev in ready_to_read:
-                self.handle_js()
+                x_due = now + X_IDLE_TIMEOUT
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--debug", "-d", action="store_true",
         help="Show debug info and unused controller inputs")
+    parser.add_argument("--uinput", "-u", action="store_true",
+        help="Send keystrokes through a uinput virtual keyboard instead of "
+        "XTEST (needs python-evdev and write access to /dev/uinput)")
     args = parser.parse_args()
     logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
         format="%(asctime)s %(levelname)s: %(message)s")
 
-    Program().run()
+    Program(args.uinput, args.debug).run()
@@ -0,0 +1,262 @@
+#
+# Copyright (C) 2022-2024 Dirk Bergstrom <dirk@otisbean.com>. All Rights Reserved.
+#
+# Xlib code for keystroke generation originally by Joel Holveck <joelh@piquan.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Keystroke senders shared by midimapper and joymapper.
+
+A sender works in two phases.  At startup, compile_key() and compile_chord()
+turn keysym names into whatever the sender needs to emit them, and start()
+does any remaining setup.  After that, send_key() and send_chord() take those
+compiled values and queue the keystrokes, and flush() pushes them out.
+
+With debug=True, each keystroke is logged as it's queued.  The flag is fixed
+when the sender is made, so logging costs nothing on the hot path when it's
+off.
+"""
+
+import logging
+import struct
+import time
+
+import Xlib.X
+import Xlib.XK
+import Xlib.keysymdef.latin1
+import Xlib.keysymdef.miscellany
+
+# An XTEST FakeInput request (see Xlib/ext/xtest.py): opcode, minor opcode,
+# length in 4-byte units, event type, keycode, delay in ms, root window, and
+# x, y.  python-xlib talks to the server in native byte order.
+FAKE_INPUT = struct.Struct('=BBHBBxxII8xhh8x')
+FAKE_INPUT_MINOR = 2
+
+# Milliseconds between pressing a chord's modifiers, its final key, and the
+# release.  XTEST events are processed like real ones, so most applications
+# don't need any; bump it (or give a chord its own) if one does.
+CHORD_DELAY = 0
+
+# How long (in seconds) incoming X traffic may wait before being read.  It's
+# only ever the odd error or MappingNotify, so it's left until the controller
+# has been quiet this long, or (in joymapper) this long has passed.
+X_IDLE_TIMEOUT = 5
+
+# X keycodes are the kernel's evdev keycodes offset by 8.  EV_KEY is from
+# linux/input-event-codes.h.
+X_KEYCODE_OFFSET = 8
+EV_KEY = 1
+
+
+class KeySender:
+    """The part common to both senders: turning keysym names into keycodes."""
+
+    def __init__(self, display, name, dry_run=False, debug=False):
+        self.display = display
+        self.name = name
+        self.dry_run = dry_run
+        self.debug = debug
+        # keysym name => keycode
+        self.keycode_cache = {}
+
+    def keysym2code(self, key):
+        """Get the sender's keycode from the textual keysym value."""
+        rv = self.keycode_cache.get(key)
+        if rv is None:
+            rv = self.display.keysym_to_keycode(Xlib.XK.string_to_keysym(key))
+            if not rv:          # I think it returns 0, but maybe None
+                raise Exception("No keycode for keysym '{}'".format(key))
+            rv = self.from_x_keycode(rv)
+            self.keycode_cache[key] = rv
+        return rv
+
+    def from_x_keycode(self, keycode):
+        """Convert an X keycode to whatever this sender uses."""
+        return keycode
+
+
+class XTestSender(KeySender):
+    """Send keystrokes through the X server's XTEST extension.
+
+    python-xlib builds every request with its general-purpose Python encoder.
+    The only requests we need are FakeInputs that differ by keycode and
+    delay, so they are packed once at startup and written straight to the
+    display's socket.
+    """
+
+    def __init__(self, display, name, dry_run=False, debug=False):
+        # Verify that the XTEST extension is present.  This is what we use
+        # to send fake key events.
+        ext = display.query_extension('XTEST')
+        if ext is None:
+            raise Exception("Cannot get XTEST extension")
+        super().__init__(display, name, dry_run, debug)
+        self.opcode = ext.major_opcode
+        # python-xlib's protocol-level connection
+        self.conn = display.display
+        # keycode => pre-encoded press-and-release request pair
+        self.requests = {}
+        self.pending = bytearray()
+
+    def fake_input(self, event_type, keycode, delay=0):
+        """Encode one FakeInput request.
+
+        The delay is in milliseconds; 0 is X.CurrentTime, i.e. right away.
+        """
+        return FAKE_INPUT.pack(self.opcode, FAKE_INPUT_MINOR,
+                               FAKE_INPUT.size // 4, event_type, keycode,
+                               delay, Xlib.X.NONE, 0, 0)
+
+    def compile_key(self, key):
+        keycode = self.keysym2code(key)
+        if keycode not in self.requests:
+            self.requests[keycode] = (
+                self.fake_input(Xlib.X.KeyPress, keycode)
+                + self.fake_input(Xlib.X.KeyRelease, keycode))
+        return keycode
+
+    def compile_chord(self, keys, delay):
+        """Encode a whole chord as a single run of requests.
+
+        The keys are pressed in order and released in reverse order.  The X
+        server waits `delay` ms before pressing the final key and again
+        before the releases.  The server applies each request's delay in
+        turn, so only the first release carries one; the rest follow
+        straight after it.
+        """
+        keycodes = tuple(map(self.keysym2code, keys))
+        releases = keycodes[::-1]
+        requests = [self.fake_input(Xlib.X.KeyPress, k)
+                    for k in keycodes[:-1]]
+        requests.append(
+            self.fake_input(Xlib.X.KeyPress, keycodes[-1], delay))
+        requests.append(
+            self.fake_input(Xlib.X.KeyRelease, releases[0], delay))
+        requests.extend(self.fake_input(Xlib.X.KeyRelease, k)
+                        for k in releases[1:])
+        return keycodes, b''.join(requests)
+
+    def start(self):
+        pass
+
+    def send_key(self, keycode):
+        """Queue a single keystroke via "press" and "release"."""
+        if self.debug:
+            logging.debug("key=%s", keycode)
+        self.pending += self.requests[keycode]
+
+    def send_chord(self, chord):
+        """Queue a chord from compile_chord()."""
+        keycodes, requests = chord
+        if self.debug:
+            logging.debug("chord=%s", keycodes)
+        self.pending += requests
+
+    def flush(self):
+        """Write everything queued to the X server in one go."""
+        if not self.pending:
+            return
+        if not self.dry_run:
+            conn = self.conn
+            # Anything python-xlib has queued up has to go first.
+            if conn.request_queue or conn.data_send:
+                self.display.flush()
+            conn.socket.sendall(self.pending)
+            # Keep python-xlib's sequence numbers in step with the server's,
+            # or it will pin replies and errors on the wrong requests.
+            conn.request_serial = (
+                conn.request_serial + len(self.pending) // FAKE_INPUT.size
+            ) % 65536
+        self.pending.clear()
+
+
+class UInputSender(KeySender):
+    """Type keystrokes on a uinput virtual keyboard.
+
+    This goes straight to the kernel, skipping the X server.  The X display is
+    only used at startup, to look up keycodes.  Needs python-evdev and write
+    access to /dev/uinput.
+    """
+
+    def __init__(self, display, name, dry_run=False, debug=False):
+        super().__init__(display, name, dry_run, debug)
+        # Every keycode we might type, so the device can advertise them.
+        self.keycodes = set()
+
+    def from_x_keycode(self, keycode):
+        """The kernel's keycode is the X one less the offset."""
+        keycode -= X_KEYCODE_OFFSET
+        self.keycodes.add(keycode)
+        return keycode
+
+    def compile_key(self, key):
+        return self.keysym2code(key)
+
+    def compile_chord(self, keys, delay):
+        """Resolve a chord to a (modifiers, key, releases, delay) tuple.
+
+        `modifiers` are the keycodes pressed before the final `key`, and
+        `releases` is every keycode in the order they're let go.
+        """
+        keycodes = tuple(map(self.keysym2code, keys))
+        return keycodes[:-1], keycodes[-1], keycodes[::-1], delay
+
+    def start(self):
+        """Create the virtual keyboard."""
+        if self.dry_run:
+            return
+        # python-evdev is only needed here, so don't insist on it otherwise.
+        import evdev
+        self.uinput = evdev.UInput({EV_KEY: sorted(self.keycodes)},
+                                   name=self.name)
+
+    def send_key(self, keycode):
+        """Press and release a single key."""
+        if self.debug:
+            logging.debug("key=%s", keycode)
+        if self.dry_run:
+            return
+        self.uinput.write(EV_KEY, keycode, 1)
+        self.uinput.syn()
+        self.uinput.write(EV_KEY, keycode, 0)
+        self.uinput.syn()
+
+    def send_chord(self, chord):
+        """Press each of the keys in turn, then release them in reverse
+        order.
+
+        There's no server to do the waiting here, so a non-zero chord delay
+        means sleeping.
+        """
+        modifiers, key, releases, delay = chord
+        if self.debug:
+            logging.debug("chord=%s", modifiers + (key,))
+        if self.dry_run:
+            return
+        for k in modifiers:
+            self.uinput.write(EV_KEY, k, 1)
+        self.uinput.syn()
+        if delay:
+            time.sleep(delay / 1000)
+        self.uinput.write(EV_KEY, key, 1)
+        self.uinput.syn()
+        if delay:
+            time.sleep(delay / 1000)
+        for k in releases:
+            self.uinput.write(EV_KEY, k, 0)
+        self.uinput.syn()
+
+    def flush(self):
+        # Every event has already been written.
+        pass
@@ -17,32 +17,117 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import functools
+import ctypes
+import os
+import selectors
 import sys
 import argparse
 import time
 import logging
-from collections import namedtuple
-from subprocess import run, CalledProcessError
+from subprocess import run, DEVNULL
 
 from alsa_midi import SequencerClient, NoteOnEvent, NoteOffEvent, \
-    ControlChangeEvent, PortUnsubscribedEvent
+    ControlChangeEvent, PortUnsubscribedEvent, RealTime
 
-import Xlib.X
-import Xlib.XK
 import Xlib.display
 # This isn't used, but it needs to be loaded to prime the extension.
 import Xlib.ext.xtest
-import Xlib.keysymdef.latin1
-import Xlib.keysymdef.miscellany
 
-Action = namedtuple("Action", ('keyspec', 'desc'))
-Button = namedtuple("Button", ('control', 'action'))
-Spinner = namedtuple("Spinner", ('control', 'action_up', 'action_down'))
-Slider = namedtuple("Slider",
-    ('control', 'delta', 'action_up', 'action_down', 'action_zero'))
-# A one-tuple is still a tuple...
-Cmd = namedtuple("Cmd", ('arg_list',))
+from keysender import CHORD_DELAY, X_IDLE_TIMEOUT, UInputSender, \
+    XTestSender
+
+
+class Action:
+    """A keyspec plus a human-readable description.
+
+    `program` is the keyspec compiled down to a list of (function, arg)
+    pairs by Program.compile_actions(), which happens once the X display is
+    open.
+    """
+
+    __slots__ = ('keyspec', 'desc', 'program')
+
+    def __init__(self, keyspec, desc):
+        self.keyspec = keyspec
+        self.desc = desc
+        self.program = None
+
+    def __repr__(self):
+        return f"Action({self.keyspec!r}, {self.desc!r})"
+
+
+class Spinner:
+    """An endless knob, with Actions for clockwise/up and
+    counter-clockwise/down.
+
+    `value` is where the knob was last seen, kept here rather than in a
+    dict keyed on the control name.
+    """
+
+    __slots__ = ('control', 'action_up', 'action_down', 'value')
+
+    def __init__(self, control, action_up, action_down):
+        self.control = control
+        self.action_up = action_up
+        self.action_down = action_down
+        self.value = None
+
+    def __repr__(self):
+        return f"Spinner({self.control!r}, value={self.value!r})"
+
+
+class Slider:
+    """A fader, which fires an Action every `delta` steps of travel.
+
+    `value` is the position we last acted on, or None until the slider has
+    been seen.
+    """
+
+    __slots__ = ('control', 'delta', 'action_up', 'action_down',
+                 'action_zero', 'value')
+
+    def __init__(self, control, delta, action_up, action_down, action_zero):
+        self.control = control
+        self.delta = delta
+        self.action_up = action_up
+        self.action_down = action_down
+        self.action_zero = action_zero
+        self.value = None
+
+    def __repr__(self):
+        return f"Slider({self.control!r}, value={self.value!r})"
+
+
+class Button:
+    """A button, which fires its Action when released."""
+
+    __slots__ = ('control', 'action')
+
+    def __init__(self, control, action):
+        self.control = control
+        self.action = action
+
+    def __repr__(self):
+        return f"Button({self.control!r}, {self.action!r})"
+
+
+class Cmd:
+    """A command-and-arguments list to run.
+
+    `wait` makes the event loop wait for the command to finish; otherwise it
+    runs in the background.
+    """
+
+    __slots__ = ('arg_list', 'wait')
+
+    def __init__(self, arg_list, wait=False):
+        self.arg_list = arg_list
+        self.wait = wait
+
+    def __repr__(self):
+        if self.wait:
+            return f"Cmd({self.arg_list!r}, wait=True)"
+        return f"Cmd({self.arg_list!r})"
 
 # Special easter egg action
 BOING = Action('Boing', 'Boing')
@@ -50,7 +135,7 @@ BOING = Action('Boing', 'Boing')
 # NOTE_MAPPING
 # This defines a mapping between a MIDI "note" (basically a button press)
 # and some action (e.g. a keyboard shortcut).  It's a dict keyed on note ID,
-# where each value is a Button namedtuple containing:
+# where each value is a Button containing:
 #
 # ("button-name", Action())
 #
@@ -60,10 +145,11 @@ BOING = Action('Boing', 'Boing')
 #
 # Where <key spec> is one of:
 #
-# tuple => emit chord
+# tuple => emit chord (a trailing int overrides CHORD_DELAY for that chord)
 # str => Emit this key (see /usr/include/X11/keysymdef.h)
 # int => wait X miliseconds
-# Cmd() => Run the given command-and-arguments list
+# Cmd() => Run the given command-and-arguments list (in the background,
+#          unless it's Cmd([...], wait=True))
 # list => Emit a sequence of key specs
 #
 # TODO function => run the function (for strange / complex stuff)
@@ -105,8 +191,7 @@ NOTE_MAPPING = {
 # As above for NOTE_MAPPING, but this maps continuous controls like spinners
 # and sliders.
 #
-# The `name` field is used as the key in the dict for storing control state, so
-# it must be unique and should be diagnostic.
+# The `name` field shows up in the debug output, so it should be diagnostic.
 #
 # Spinners have two Actions: clockwise/up and counter-clockwise/down.
 # Spinners are implemented as continuous controls that wrap around, as opposed
@@ -141,18 +226,50 @@ CONTROL_MAPPING = {
                 Action([('Control_L', 'Alt_L', 'E')], 'Fit to Window')),
 }
 
+# The mappings again as lists indexed by MIDI note / control number (both
+# 0-127), so the main loop doesn't have to hash anything.  Controls are split
+# by kind, so it doesn't have to check their types either.
+_NOTE_TABLE = [NOTE_MAPPING.get(note) for note in range(128)]
+_SPINNER_TABLE = [c if isinstance(c, Spinner) else None
+                  for c in map(CONTROL_MAPPING.get, range(128))]
+_SLIDER_TABLE = [c if isinstance(c, Slider) else None
+                 for c in map(CONTROL_MAPPING.get, range(128))]
+
 # What device are we looking at?
 CONTROLLER_DEVICE = "X-TOUCH MINI"
 
+# The most clicks one spinner event may stand for.  A fast spin coalesced
+# into one event can cover a few; anything bigger is more likely a stale or
+# out-of-order value than a real move.
+SPINNER_MAX_REPEAT = 8
+
+# Seconds between the frames of the init_knobs() light show.
+STROBE_INTERVAL = 0.007
+# The light show (about 600 events) is handed to the sequencer in one go, so
+# the kernel has to be able to hold all of it.  The default pool is 500.
+SEQ_OUTPUT_POOL = 1024
+
+# SCHED_FIFO priority for --rt.  Enough to get ahead of the desktop, well
+# below the kernel's own threads and the likes of JACK.
+RT_PRIORITY = 20
+# From sys/mman.h
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
 
 class Program:
     """The action all happens here"""
 
     control_default = 64
 
-    def __init__(self, dry_run) -> None:
+    def __init__(self, dry_run, use_uinput=False, debug=False) -> None:
         self.dry_run = dry_run
-        self.state = {}
+        self.use_uinput = use_uinput
+        self.debug = debug
+        # pid => command name, for commands running in the background
+        self.children = {}
+        # Monotonic time when the init_knobs() light show is over, or 0
+        self.strobe_until = 0
 
     def init_knobs(self):
         """Set all the knob controllers to their middle value, the fun way.
@@ -160,177 +277,322 @@ class Program:
         The X-Touch MINI has some state memory, so the values of the inputs
         and their associated lights need to be set to a known state.  I got
         just a bit carried away implementing this code...
+
+        Every frame goes out at once, timestamped relative to now on
+        self.queue, and the sequencer plays them back at the right moments.
+        So this returns straight away, rather than sleeping through the show.
+        Until it's over the knobs report the show rather than the user, so
+        read_events() drops control changes until strobe_until.
         """
+        # event_output() copies each event into ALSA's buffer, so the same
+        # three are reused for the whole show.
+        cc = ControlChangeEvent(channel=10, param=0, value=0, relative=True)
+        note_on = NoteOnEvent(channel=10, note=0, relative=True)
+        note_off = NoteOffEvent(channel=10, note=0, relative=True)
+
+        def output(nevt):
+            self.client.event_output(nevt, queue=self.queue, port=self.port)
+
+        def set_time(when):
+            cc.time = note_on.time = note_off.time = RealTime(when)
+
         def do_strobe(val):
+            cc.value = val
             for param in range(1, 9):
-                nevt = ControlChangeEvent(channel=10, param=param, value=val)
-                self.client.event_output(nevt, port=self.port)
+                cc.param = param
+                output(cc)
             if val % 16 == 0:
                 note1 = (val // 16) + 8
                 note2 = 23 - (val // 16)
-                nevt = NoteOnEvent(channel=10, note=note1)
-                self.client.event_output(nevt, port=self.port)
-                nevt = NoteOffEvent(channel=10, note=note1 - 1)
-                self.client.event_output(nevt, port=self.port)
-                nevt = NoteOnEvent(channel=10, note=note2)
-                self.client.event_output(nevt, port=self.port)
-                nevt = NoteOffEvent(channel=10, note=note2 + 1)
-                self.client.event_output(nevt, port=self.port)
-            self.client.drain_output()
-            time.sleep(0.007)
-        for val in range(0, 127, 4):
-            do_strobe(val)
-        for val in range(128, 0, -4):
+                note_on.note = note1
+                output(note_on)
+                note_off.note = note1 - 1
+                output(note_off)
+                note_on.note = note2
+                output(note_on)
+                note_off.note = note2 + 1
+                output(note_off)
+        frames = list(range(0, 127, 4)) + list(range(128, 0, -4))
+        for frame, val in enumerate(frames):
+            set_time(frame * STROBE_INTERVAL)
             do_strobe(val)
+        show_length = len(frames) * STROBE_INTERVAL
+        set_time(show_length)
+        cc.value = self.control_default
         for param in range(1, 9):
-            nevt = ControlChangeEvent(channel=10, param=param,
-                value=self.control_default)
-            self.client.event_output(nevt, port=self.port)
-            nevt = NoteOffEvent(channel=10, note=param + 7)
-            self.client.event_output(nevt, port=self.port)
-            nevt = NoteOffEvent(channel=10, note=param + 15)
-            self.client.event_output(nevt, port=self.port)
+            cc.param = param
+            output(cc)
+            note_off.note = param + 7
+            output(note_off)
+            note_off.note = param + 15
+            output(note_off)
         self.client.drain_output()
+        # Allow an extra frame for anything already on its way back.
+        self.strobe_until = time.monotonic() + show_length + STROBE_INTERVAL
+        for control in CONTROL_MAPPING.values():
+            if isinstance(control, Spinner):
+                control.value = self.control_default
 
     def set_control(self, param, new_value):
         """Set a MIDI control to a specific value.
         
-        Used when wrapping a spinner around from 127 <=> 0.
+        Used when wrapping a spinner around from 127 <=> 0.  This goes out
+        straight away: the spinner's value has already wrapped, and until the
+        device has too, a click back would be counted the whole way round.
         """
         nevt = ControlChangeEvent(channel=10, param=param, value=new_value)
         self.client.event_output(nevt, port=self.port)
         self.client.drain_output()
 
-    @functools.lru_cache()
-    def keysym2code(self, key):
-        """Get the actual X keycode from the textual keysim value."""
-        rv = self.display.keysym_to_keycode(Xlib.XK.string_to_keysym(key))
-        if not rv:              # I think it returns 0, but maybe None
-            raise Exception("No keycode for keysym '{}'".format(key))
-        return rv
-
-    def send_chord(self, keys):
-        """Send X keypress events for each of the keys, wait 10ms, then release
-        the keys in reverse order with a 20ms delay.
-        """
-        logging.debug("chord=%s", keys)
-        keycodes = list(map(self.keysym2code, keys))
-        if self.dry_run:
-            return
-        # We set the times with 10ms between the modifiers, the final
-        # key, and the release.  (The default for the last argument is
-        # X.CurrentTime.)
-        for k in keycodes[:-1]:
-            self.display.xtest_fake_input(Xlib.X.KeyPress, k, 0)
-        self.display.xtest_fake_input(Xlib.X.KeyPress, keycodes[-1], 10)
-        for k in reversed(keycodes):
-            self.display.xtest_fake_input(Xlib.X.KeyRelease, k, 20)
-        # Send the event stream.
-        self.display.flush()
-
-    def send_key(self, key):
-        """Send a single X keystroke via "press" and "release"."""
-        logging.debug("key=%s", key)
-        keycode = self.keysym2code(key)
-        if self.dry_run:
-            return
-        self.display.xtest_fake_input(Xlib.X.KeyPress, keycode)
-        self.display.xtest_fake_input(Xlib.X.KeyRelease, keycode)
-        self.display.flush()
-
     def handle_slider(self, slider_spec, event):
         """Handle a slider change event.
         
         If the difference between current and previous value exceeds
         slider_spec.delta, or the slider is changed to zero, the relevant
-        Action is returned.  Otherwise we return None.
+        Action is returned, along with how many times to repeat it (a
+        coalesced event can cover several deltas' worth of travel).
+        Otherwise we return (None, 0).
         """
-        # control, delta, value, action_up, action_down, action_zero
-        prev_value = self.state.get(slider_spec.control)
+        prev_value = slider_spec.value
         if event.value == 0 and slider_spec.action_zero is not None:
-            self.state[slider_spec.control] = 0
-            return slider_spec.action_zero
+            slider_spec.value = 0
+            return slider_spec.action_zero, 1
         if prev_value is None:
             # We have no way of knowing where the slider was before...
-            self.state[slider_spec.control] = event.value
-            return None
+            slider_spec.value = event.value
+            return None, 0
+        step = slider_spec.delta + 1
+        count = abs(event.value - prev_value) // step
         if event.value < prev_value - slider_spec.delta:
-            self.state[slider_spec.control] = event.value
-            return slider_spec.action_down
-        if event.value == 127 or event.value > prev_value + slider_spec.delta:
-            self.state[slider_spec.control] = event.value
-            return slider_spec.action_up
-        return None
+            slider_spec.value = prev_value - count * step
+            return slider_spec.action_down, count
+        if event.value == 127:
+            slider_spec.value = event.value
+            return slider_spec.action_up, max(count, 1)
+        if event.value > prev_value + slider_spec.delta:
+            slider_spec.value = prev_value + count * step
+            return slider_spec.action_up, count
+        return None, 0
 
     def handle_spinner(self, spinner, event):
         """Handle a spinner change event.
         
         Handles wraparound when the spinner hits the ends of its built-in range.
+
+        Returns the Action (or None) and how many times to repeat it, which
+        is how many clicks the spinner moved, up to SPINNER_MAX_REPEAT.
         """
-        # control, value, action_up, action_down
-        prev_value = self.state.get(spinner.control, self.control_default)
         new_value = event.value
-        retval = None
+        step = new_value - spinner.value
+        # Since we wrap it, the spinner's range is a ring, so take the short
+        # way round.  A longer jump means the device and we disagree about
+        # where it is (e.g. a value sent before a wraparound reset landed),
+        # not a half-turn in one go.
+        if step > 63:
+            step -= 128
+        elif step < -63:
+            step += 128
         if new_value in (0, 127):
             # Spinner has hit the end of its range, wrap it around.
             # Outputting a new event will:
             # - Change the current value of the knob
             # - Change the LED lights correspondingly
             if new_value == 0:
+                step = step or -1
                 new_value = 127
-                retval = spinner.action_down
             else:
+                step = step or 1
                 new_value = 0
-                retval = spinner.action_up
             self.set_control(event.param, new_value)
-        elif new_value < prev_value:
-            retval = spinner.action_down
-        elif new_value > prev_value:
-            retval = spinner.action_up
-        self.state[spinner.control] = new_value
-        return retval
+        spinner.value = new_value
+        if step < 0:
+            return spinner.action_down, min(-step, SPINNER_MAX_REPEAT)
+        if step > 0:
+            return spinner.action_up, min(step, SPINNER_MAX_REPEAT)
+        return None, 0
+
+    def read_events(self):
+        """Wait for MIDI input, then grab everything else already queued.
+
+        ControlChangeEvents for the same param are collapsed into the last
+        one, so a fast spin is handled as one multi-click move.  The merged
+        event keeps the place of the first, so turning two knobs at once
+        still comes out in a predictable order.  Other events are never
+        reordered, and a control's events aren't merged across them; a
+        button pressed mid-spin lands between the moves either side of it.
+        Returns an empty list if nothing turned up for X_IDLE_TIMEOUT seconds.
+
+        Events come from ALSA's user-space buffer while it has any, and
+        otherwise from the sequencer fd once the selector says it's readable.
+        After the first event we only poll, so this never blocks mid-batch.
+        """
+        events = []
+        # param => index in events of the ControlChangeEvent to overwrite
+        latest = {}
+        timeout = X_IDLE_TIMEOUT
+        while (self.client.event_input_pending()
+               or self.selector.select(timeout)):
+            event = self.client.event_input()
+            timeout = 0
+            if event.type == ControlChangeEvent.type:
+                if self.strobe_until:
+                    # Knob positions mean nothing while the light show runs.
+                    if time.monotonic() < self.strobe_until:
+                        continue
+                    self.strobe_until = 0
+                index = latest.get(event.param)
+                if index is not None:
+                    events[index] = event
+                    continue
+                latest[event.param] = len(events)
+            elif latest:
+                latest.clear()
+            events.append(event)
+        return events
+
+    def handle_x(self):
+        """Throw away any queued X events.
+
+        We don't need to process any X events, but python-xlib reads
+        whatever the server sends while flushing, and it will pile up if
+        nobody takes it off the queue.  XTEST requests don't generate
+        replies, so this is only the odd error or MappingNotify and can wait
+        until the controller is idle.
+        """
+        for _ in range(self.display.pending_events()):
+            self.display.next_event()
 
     def run_command(self, cmd_spec):
-        """Run a command as specified by a Cmd namedtuple."""
-        try:
-            run(cmd_spec.arg_list)
-        except CalledProcessError:
-            logging.info("Command '%s' failed.", cmd_spec.arg_list[0])
+        """Run a command as specified by a Cmd.
 
-    def do_action(self, action):
-        """Do whatever the supplied Action specifies."""
-        if action == BOING:
-            self.init_knobs()
+        Unless the Cmd says to wait, the command is started and left to
+        run, so MIDI events keep getting handled in the meantime;
+        reap_children() collects it once it's done.
+
+        Commands get their own session, so a Ctrl-C meant for us doesn't
+        take them down too, and read from /dev/null rather than our
+        terminal.
+        """
+        # Keystrokes before the command in a sequence go out first.
+        self.sender.flush()
+        name = cmd_spec.arg_list[0]
+        try:
+            if cmd_spec.wait:
+                returncode = run(cmd_spec.arg_list, stdin=DEVNULL,
+                                 start_new_session=True).returncode
+            else:
+                pid = os.posix_spawnp(name, cmd_spec.arg_list, os.environ,
+                    file_actions=[(os.POSIX_SPAWN_OPEN, 0, os.devnull,
+                                   os.O_RDONLY, 0)],
+                    setsid=True)
+                self.children[pid] = name
+                return
+        except OSError as ose:
+            logging.info("Command '%s' failed: %s", name, ose)
             return
-        logging.info("Action %s => %s", action.desc, action.keyspec)
-        if not action.keyspec:
+        if returncode:
+            logging.info("Command '%s' failed.", name)
+
+    def reap_children(self):
+        """Collect any background commands that have finished."""
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.children.clear()
+                return
+            if not pid:
+                return
+            name = self.children.pop(pid, None)
+            if not os.WIFEXITED(status) or os.WEXITSTATUS(status):
+                logging.info("Command '%s' failed.", name)
+
+    def pause(self, seconds):
+        """Flush any pending keystrokes, then sleep."""
+        self.sender.flush()
+        time.sleep(seconds)
+
+    def do_action(self, action, count=1):
+        """Do whatever the supplied Action specifies, `count` times over.
+
+        The keystrokes for all the repeats go out in one flush.
+        """
+        if action is BOING:
+            self.init_knobs()
             return
-        self._do_keyspec(action.keyspec, action)
+        logging.info("Action %s => %s (x%d)", action.desc, action.keyspec,
+                     count)
+        for _ in range(count):
+            for fn, arg in action.program:
+                fn(arg)
+        self.sender.flush()
 
-    def _do_keyspec(self, keyspec, action):
-        """Actually do the thing specified in the keyspec.
-        
-        Send some keystroke(s), run a command, or recurse on list elements.
+    def _compile_keyspec(self, keyspec, action):
+        """Flatten a keyspec into a list of (function, arg) pairs.
+
+        Keysyms are compiled by the sender here, so that all the type
+        checking and lookups happen once at startup rather than on every
+        event.
 
-        Note that order is important here, as Cmd() is a namedTUPLE, and thus
-        is an instance of `tuple`.
+        The compiler is picked by the keyspec's exact type.
         """
-        if isinstance(keyspec, Cmd):
-            self.run_command(keyspec)
-        elif isinstance(keyspec, list):
-            # List of things to do
-            for elem in keyspec:
-                self._do_keyspec(elem, action)
-        elif isinstance(keyspec, tuple):
-            self.send_chord(keyspec)
-        elif isinstance(keyspec, str):
-            self.send_key(keyspec)
-        elif isinstance(keyspec, int):
-            # Sleep times are specified in milliseconds
-            time.sleep(keyspec / 1000)
-        else:
+        compile_fn = self.compilers.get(type(keyspec))
+        if compile_fn is None:
             raise Exception(
                 f"Unsupported keyspec of type {type(keyspec)} in Action {action}")
+        return compile_fn(keyspec, action)
+
+    def _compile_cmd(self, cmd_spec, action):
+        return [(self.run_command, cmd_spec)]
+
+    def _compile_list(self, keyspecs, action):
+        # List of things to do
+        program = []
+        for elem in keyspecs:
+            program.extend(self._compile_keyspec(elem, action))
+        return program
+
+    def _compile_chord(self, keys, action):
+        """Have the sender compile a chord.
+
+        The delay is CHORD_DELAY, unless the chord ends with an int.
+        """
+        delay = CHORD_DELAY
+        if isinstance(keys[-1], int):
+            keys, delay = keys[:-1], keys[-1]
+        return [(self.sender.send_chord,
+                 self.sender.compile_chord(keys, delay))]
+
+    def _compile_key(self, key, action):
+        return [(self.sender.send_key, self.sender.compile_key(key))]
+
+    def _compile_sleep(self, millis, action):
+        # Sleep times are specified in milliseconds
+        return [(self.pause, millis / 1000)]
+
+    def compile_actions(self):
+        """Compile the keyspec of every Action in the mappings."""
+        self.compilers = {
+            Cmd: self._compile_cmd,
+            list: self._compile_list,
+            tuple: self._compile_chord,
+            str: self._compile_key,
+            int: self._compile_sleep,
+        }
+        actions = [button.action for button in NOTE_MAPPING.values()]
+        for control in CONTROL_MAPPING.values():
+            if not isinstance(control, (Spinner, Slider)):
+                raise Exception(f"Unsupported handler type '{control}'.")
+            actions.extend((control.action_up, control.action_down))
+            if isinstance(control, Slider):
+                actions.append(control.action_zero)
+        actions = [a for a in actions if a is not None and a is not BOING]
+        for action in actions:
+            if action.keyspec:
+                action.program = self._compile_keyspec(action.keyspec, action)
+            else:
+                action.program = []
+        self.sender.start()
 
     def run(self):
         """The main loop of the program.
@@ -348,13 +610,16 @@ class Program:
         <NoteOnEvent channel=10 note=8 velocity=127>
         https://python-alsa-midi.readthedocs.io/en/latest/api_events.html
         """
-        # Get a handle for the Display
+        # Get a handle for the Display.  Even with --uinput we need this to
+        # look up keycodes.
         self.display = Xlib.display.Display()
-        # Verify that the XTEST extension is present.  This is what we use
-        # to send fake key events.
-        ext = self.display.query_extension('XTEST')
-        if ext is None:
-            raise Exception("Cannot get XTEST extension")
+        if self.use_uinput:
+            sender_class = UInputSender
+        else:
+            sender_class = XTestSender
+        self.sender = sender_class(self.display, 'midimapper', self.dry_run,
+                                   self.debug)
+        self.compile_actions()
 
         # Connect to the MIDI device.
         # TODO This is kind of cargo-culted from the library's example code.
@@ -363,44 +628,109 @@ class Program:
         self.port = self.client.create_port("inout")
         self.port.connect_from(self.client.list_ports()[0])
         self.port.connect_to(self.client.list_ports()[0])
+        # For scheduling init_knobs()' light show.  Starting the queue takes
+        # effect when init_knobs() drains the output.
+        self.client.set_client_pool_output(SEQ_OUTPUT_POOL)
+        self.queue = self.client.create_queue()
+        self.queue.start()
         logging.info("Mapping inputs from %s", CONTROLLER_DEVICE)
 
+        # epoll on Linux.  python-alsa-midi doesn't have a public accessor
+        # for the sequencer's poll descriptor, hence _fd.
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.client._fd, selectors.EVENT_READ)
+
         self.init_knobs()
 
+        # This loop runs for every MIDI event, so look everything it uses
+        # up once, here.
+        debug = self.debug
+        read_events = self.read_events
+        handle_spinner = self.handle_spinner
+        handle_slider = self.handle_slider
+        do_action = self.do_action
+        note_table = _NOTE_TABLE
+        spinner_table = _SPINNER_TABLE
+        slider_table = _SLIDER_TABLE
+        control_change = ControlChangeEvent.type
+        note_on = NoteOnEvent.type
+        note_off = NoteOffEvent.type
+        port_unsubscribed = PortUnsubscribedEvent.type
+
         while True:
-            event = self.client.event_input()
-            logging.debug(event)
-            action = None
-            if event.type == PortUnsubscribedEvent.type:
-                # Controller disconnected.
-                # For now we gracefully exit.
-                # TODO Consider waiting for a reconnection?
-                logging.info("Controller '%s' disconnected or unavailable.",
-                            CONTROLLER_DEVICE)
-                sys.exit(0)
-            elif event.type == NoteOnEvent.type:
-                # This is a button press; we trigger on the button release event.
+            events = read_events()
+            if self.children:
+                self.reap_children()
+            if not events:
+                self.handle_x()
                 continue
-            elif event.type == NoteOffEvent.type:
-                # A button release, which maps directly to an Action
-                handler = NOTE_MAPPING.get(event.note)
-                if handler:
-                    action = handler.action
-            elif event.type == ControlChangeEvent.type:
-                # Spinner or slider event, which requires some interpretation
-                # to determine the correct action.
-                handler = CONTROL_MAPPING.get(event.param)
-                if isinstance(handler, Spinner):
-                    action = self.handle_spinner(handler, event)
-                elif isinstance(handler, Slider):
-                    action = self.handle_slider(handler, event)
-                elif handler is not None:
-                    logging.error("Unsupported handler type '%s'.", handler)
-            else:
-                logging.debug("Unsupported event type '%s'.", event.type)
-            # Only some events actually trigger Actions
-            if action:
-                self.do_action(action)
+            # Set once a Boing has reset the knobs; control changes later
+            # in the same batch were sent before that.
+            knobs_reset = False
+            for event in events:
+                if debug:
+                    logging.debug(event)
+                action = None
+                count = 1
+                # Knob events are the bulk of the traffic, so they're
+                # checked first.
+                event_type = event.type
+                if event_type == control_change:
+                    if knobs_reset:
+                        continue
+                    # Spinner or slider event, which requires some interpretation
+                    # to determine the correct action.
+                    spinner = spinner_table[event.param]
+                    if spinner:
+                        action, count = handle_spinner(spinner, event)
+                    else:
+                        slider = slider_table[event.param]
+                        if slider:
+                            action, count = handle_slider(slider, event)
+                elif event_type == note_on:
+                    # This is a button press; we trigger on the button release event.
+                    continue
+                elif event_type == note_off:
+                    # A button release, which maps directly to an Action
+                    handler = note_table[event.note]
+                    if handler:
+                        action = handler.action
+                elif event_type == port_unsubscribed:
+                    # Controller disconnected.
+                    # For now we gracefully exit.
+                    # TODO Consider waiting for a reconnection?
+                    logging.info("Controller '%s' disconnected or unavailable.",
+                                CONTROLLER_DEVICE)
+                    sys.exit(0)
+                elif debug:
+                    logging.debug("Unsupported event type '%s'.", event_type)
+                # Only some events actually trigger Actions
+                if action:
+                    do_action(action, count)
+                    if action is BOING:
+                        knobs_reset = True
+
+
+def set_realtime():
+    """Lock our memory and switch to real-time scheduling, as far as allowed.
+
+    What matters here is how promptly a keystroke goes out, not throughput,
+    so we don't want to wait behind a busy desktop or for a page fault in
+    the middle of a chord.  Either step may be refused for lack of
+    privileges, in which case we carry on without it.
+
+    The real-time policy isn't passed on to the commands we run, or a
+    runaway one could starve the desktop.
+    """
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.mlockall(MCL_CURRENT | MCL_FUTURE) != 0:
+        logging.warning("Couldn't lock memory: %s",
+                        os.strerror(ctypes.get_errno()))
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO | os.SCHED_RESET_ON_FORK,
+                              os.sched_param(RT_PRIORITY))
+    except PermissionError as err:
+        logging.warning("Couldn't switch to real-time scheduling: %s", err)
 
 
 if __name__ == "__main__":
@@ -409,8 +739,15 @@ if __name__ == "__main__":
         help="Show debug info and unused controller inputs")
     parser.add_argument("--dry-run", "-n", action="store_true",
         help="Don't actually emit X keystrokes")
+    parser.add_argument("--uinput", "-u", action="store_true",
+        help="Send keystrokes through a uinput virtual keyboard instead of "
+        "XTEST (needs python-evdev and write access to /dev/uinput)")
+    parser.add_argument("--rt", action="store_true",
+        help="Lock memory and use real-time scheduling, if permitted")
     args = parser.parse_args()
     logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
         format="%(asctime)s %(levelname)s: %(message)s")
+    if args.rt:
+        set_realtime()
 
-    Program(args.dry_run).run()
+    Program(args.dry_run, args.uinput, args.debug).run()